@@ -1,13 +1,48 @@
 #!/usr/bin/env python3
 
+import io
 import os
-import gzip
 import shutil
+import tarfile
+import subprocess
+import time
 import datetime
 import argparse
-import glob
+import heapq
+import concurrent.futures
+import queue
 import logging
+import logging.handlers
 from pathlib import Path
+from dataclasses import dataclass
+
+# O formato de log não usa thread/processo, então essas informações não são coletadas
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+# Usa o ISA-L (pip install isal) para acelerar o gzip, se estiver instalado
+try:
+    from isal import igzip as gzip_impl
+    ISAL_DISPONIVEL = True
+except ImportError:
+    import gzip as gzip_impl
+    ISAL_DISPONIVEL = False
+
+
+# Tamanho dos buffers de cópia e de escrita do arquivo comprimido (1 MiB)
+TAMANHO_BUFFER = 1 << 20
+
+# Unidades usadas para exibir tamanhos, em potências de 1024
+UNIDADES_TAMANHO = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+# Prefixo e extensão dos arquivos de backup gerados pelo script
+PREFIXO_BACKUP = "backup_"
+EXTENSAO_BACKUP = ".tar.gz"
+
+# Subpasta do destino onde os logs são salvos por padrão, e a extensão desses logs
+PASTA_LOGS = "logs"
+EXTENSAO_LOG = ".log"
 
 
 def configurar_logger(log_file=None):
@@ -17,8 +52,12 @@ def configurar_logger(log_file=None):
     Args:
         log_file (str): Caminho para o arquivo de log. Se None, apenas log no console
     
+    As mensagens são enviadas para uma fila e escritas no console/arquivo por
+    uma thread separada, para que as chamadas de log não bloqueiem no I/O.
+    O listener retornado deve ser parado ao final da execução.
+    
     Returns:
-        logger: Objeto logger configurado
+        tuple: (logger configurado, QueueListener que escreve as mensagens)
     """
     # Criar logger
     logger = logging.getLogger('backup_script')
@@ -30,18 +69,101 @@ def configurar_logger(log_file=None):
     # Adicionar handler para console
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
     
-    # Adicionar handler para arquivo se especificado
+    # Adicionar handler para arquivo se especificado. O arquivo é aberto aqui, antes
+    # de iniciar o listener, para que um caminho inválido interrompa o script
     if log_file:
         file_handler = logging.FileHandler(log_file)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+    
+    # O logger apenas enfileira as mensagens; o listener as escreve em segundo plano
+    fila = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(fila))
+    listener = logging.handlers.QueueListener(fila, *handlers, respect_handler_level=True)
+    listener.start()
+    
+    return logger, listener
+
+
+@dataclass
+class EstatisticasBackup:
+    """Estatísticas coletadas durante a criação de um backup"""
+    tamanho_origem: int = 0
+    arquivos: int = 0
+    tamanho_backup: int = 0
+    
+    @property
+    def taxa_compressao(self):
+        """Razão entre o tamanho original e o tamanho comprimido"""
+        return self.tamanho_origem / self.tamanho_backup if self.tamanho_backup > 0 else 0
+
+
+class ContadorBytes:
+    """Repassa as escritas para outro arquivo, contando os bytes escritos"""
     
-    return logger
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.total = 0
+    
+    def write(self, dados):
+        self.total += len(dados)
+        return self.arquivo.write(dados)
+    
+    def flush(self):
+        self.arquivo.flush()
 
 
-def comprimir_pasta(pasta_origem, arquivo_destino, nivel_compressao=6, logger=None):
+def comprimir_com_pigz(pigz_path, pasta_origem, arquivo_destino, nivel_compressao=6, filtro=None):
+    """
+    Comprime uma pasta em tar.gz usando pigz (gzip multi-thread)
+    
+    O tar é gerado pelo tarfile e enviado ao pigz pela entrada padrão
+    
+    Args:
+        pigz_path (str): Caminho do executável pigz
+        pasta_origem (str): Caminho da pasta a ser comprimida
+        arquivo_destino (str): Caminho do arquivo de saída
+        nivel_compressao (int): Nível de compressão (1-9)
+        filtro: Função aplicada a cada TarInfo adicionado ao arquivo
+    
+    Returns:
+        int: Quantidade de bytes escritos no arquivo de saída
+    
+    Raises:
+        subprocess.SubprocessError: Se o pigz não puder ser iniciado ou falhar
+            (subprocess.CalledProcessError se terminar com erro). Erros de leitura
+            da pasta de origem são propagados sem alteração
+    """
+    comando = [pigz_path, f"-{nivel_compressao}", "-p", str(os.cpu_count() or 1)]
+    
+    with open(arquivo_destino, 'wb') as f_out:
+        try:
+            pigz = subprocess.Popen(comando, stdin=subprocess.PIPE, stdout=f_out)
+        except OSError as e:
+            raise subprocess.SubprocessError(f"Não foi possível iniciar o pigz: {e}") from e
+        
+        pipe_quebrado = None
+        with pigz:
+            try:
+                with tarfile.open(fileobj=pigz.stdin, mode='w|', bufsize=TAMANHO_BUFFER,
+                                  copybufsize=TAMANHO_BUFFER) as tar:
+                    tar.add(pasta_origem, arcname=os.path.basename(os.path.normpath(pasta_origem)), filter=filtro)
+            except BrokenPipeError as e:
+                # O pigz encerrou antes de receber todo o tar
+                pipe_quebrado = e
+        
+        if pigz.returncode != 0:
+            raise subprocess.CalledProcessError(pigz.returncode, pigz.args)
+        if pipe_quebrado:
+            raise subprocess.SubprocessError(f"O pigz encerrou a entrada antes do fim: {pipe_quebrado}")
+        
+        # O pigz escreve no mesmo descritor, então a posição atual é o tamanho do arquivo
+        return f_out.tell()
+
+
+def comprimir_pasta(pasta_origem, arquivo_destino, nivel_compressao=6, logger=None, excluir_logs=False):
     """
     Comprime uma pasta inteira em um arquivo tar.gz
     
@@ -50,59 +172,116 @@ def comprimir_pasta(pasta_origem, arquivo_destino, nivel_compressao=6, logger=No
         arquivo_destino (str): Caminho do arquivo de saída
         nivel_compressao (int): Nível de compressão (1-9)
         logger: Objeto logger para registrar as operações
+        excluir_logs (bool): Se o destino for a própria origem, ignora os logs gerados
+            pelo script na pasta de logs padrão
+    
+    Returns:
+        tuple: (sucesso, EstatisticasBackup com os tamanhos e a quantidade de arquivos)
     """
     if logger:
-        logger.info(f"Iniciando compressão da pasta {pasta_origem}")
-        logger.info(f"Nível de compressão: {nivel_compressao}")
+        logger.info("Iniciando compressão da pasta %s", pasta_origem)
+        logger.info("Nível de compressão: %s", nivel_compressao)
     
-    try:
-        # Primeiro criamos um arquivo tar temporário
-        temp_tar = f"{arquivo_destino}.temp.tar"
-        
+    # As estatísticas da origem são somadas durante a criação do tar, sem percorrer a pasta novamente
+    estatisticas = EstatisticasBackup()
+    
+    # Se o destino estiver dentro da origem, os backups anteriores não entram no novo backup
+    nome_origem = os.path.basename(os.path.normpath(pasta_origem))
+    pasta_logs = f"{nome_origem}/{PASTA_LOGS}"
+    membro_excluido = None
+    destino_igual_origem = False
+    relativo = os.path.relpath(
+        os.path.realpath(os.path.dirname(os.path.abspath(arquivo_destino))),
+        os.path.realpath(pasta_origem)
+    )
+    if relativo == os.curdir:
+        # Destino igual à origem: ignora apenas os arquivos gerados pelo próprio script
+        destino_igual_origem = True
         if logger:
-            logger.debug(f"Criando arquivo tar temporário: {temp_tar}")
-        
-        # A função make_archive do shutil cria um arquivo tar
-        shutil.make_archive(
-            os.path.splitext(temp_tar)[0],  # Nome base (sem extensão)
-            'tar',                           # Formato
-            root_dir=os.path.dirname(pasta_origem),
-            base_dir=os.path.basename(pasta_origem)
-        )
-        
-        # Calculando tamanho do arquivo tar para registro
-        tar_size = os.path.getsize(temp_tar)
+            logger.info("Pasta de destino é a própria origem, backups e logs anteriores serão ignorados")
+    elif relativo != os.pardir and not relativo.startswith(os.pardir + os.sep):
+        membro_excluido = os.path.join(nome_origem, relativo).replace(os.sep, '/')
         if logger:
-            logger.debug(f"Arquivo tar criado: {temp_tar} ({tar_size} bytes)")
-        
-        # Agora comprimimos o arquivo tar com gzip
+            logger.info("Pasta de destino está dentro da origem e será ignorada: %s", membro_excluido)
+    
+    def preparar_membro(tarinfo):
+        # Excluir o diretório também impede que o tarfile percorra o seu conteúdo
+        if tarinfo.name == membro_excluido:
+            return None
+        if destino_igual_origem and tarinfo.isreg():
+            pasta, _, nome = tarinfo.name.rpartition('/')
+            if nome.startswith(PREFIXO_BACKUP) and (
+                (pasta == nome_origem and nome.endswith(EXTENSAO_BACKUP))
+                or (excluir_logs and pasta == pasta_logs and nome.endswith(EXTENSAO_LOG))
+            ):
+                return None
+        estatisticas.tamanho_origem += tarinfo.size
+        if tarinfo.isreg():
+            estatisticas.arquivos += 1
+        return tarinfo
+    
+    try:
         if logger:
-            logger.debug(f"Comprimindo arquivo tar com gzip para: {arquivo_destino}")
+            logger.debug("Criando arquivo tar.gz: %s", arquivo_destino)
         
-        with open(temp_tar, 'rb') as f_in:
-            with gzip.open(arquivo_destino, 'wb', compresslevel=nivel_compressao) as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        
-        # Calculando tamanho do arquivo comprimido para log
-        gz_size = os.path.getsize(arquivo_destino)
-        compression_ratio = tar_size / gz_size if gz_size > 0 else 0
+        # Se o pigz estiver disponível, a compressão é feita em paralelo
+        pigz_path = shutil.which("pigz")
+        if pigz_path:
+            try:
+                estatisticas.tamanho_backup = comprimir_com_pigz(pigz_path, pasta_origem, arquivo_destino, nivel_compressao, preparar_membro)
+                if logger:
+                    logger.info("Compressão realizada com pigz: %s", pigz_path)
+            except subprocess.SubprocessError as e:
+                if logger:
+                    logger.warning("Falha ao comprimir com pigz, usando gzip do Python: %s", e)
+                pigz_path = None
+                estatisticas = EstatisticasBackup()
+        else:
+            if logger:
+                logger.debug("pigz não encontrado, usando gzip do Python")
         
-        # Removemos o arquivo tar temporário
-        os.remove(temp_tar)
+        if not pigz_path:
+            # O ISA-L aceita apenas os níveis 0-3, então o nível 1-9 é convertido
+            nivel_gzip = min(3, (nivel_compressao - 1) // 2) if ISAL_DISPONIVEL else nivel_compressao
+            
+            # O tar é gerado e comprimido em uma única passagem, sem arquivo temporário.
+            # Um buffer grande entre o gzip e o disco reduz a quantidade de escritas
+            with open(arquivo_destino, 'wb', buffering=0) as raw, \
+                    io.BufferedWriter(raw, buffer_size=TAMANHO_BUFFER) as buf:
+                contador = ContadorBytes(buf)
+                with gzip_impl.GzipFile(fileobj=contador, mode='wb', compresslevel=nivel_gzip) as gz, \
+                        tarfile.open(fileobj=gz, mode='w', copybufsize=TAMANHO_BUFFER) as tar:
+                    tar.add(pasta_origem, arcname=os.path.basename(os.path.normpath(pasta_origem)),
+                            filter=preparar_membro)
+            estatisticas.tamanho_backup = contador.total
+            if logger:
+                if ISAL_DISPONIVEL:
+                    logger.info("Compressão realizada com ISA-L (nível %s)", nivel_gzip)
+                else:
+                    logger.info("Compressão realizada com gzip do Python")
         
         if logger:
-            logger.info(f"Backup criado com sucesso: {arquivo_destino} ({gz_size} bytes)")
-            logger.info(f"Taxa de compressão: {compression_ratio:.2f}x")
+            logger.info("Backup criado com sucesso: %s (%s bytes)", arquivo_destino, estatisticas.tamanho_backup)
+            logger.info("Taxa de compressão: %.2fx", estatisticas.taxa_compressao)
         else:
             print(f"Backup criado com sucesso: {arquivo_destino}")
         
-        return True
+        return True, estatisticas
     except Exception as e:
         if logger:
-            logger.error(f"Erro ao comprimir pasta: {str(e)}")
+            logger.error("Erro ao comprimir pasta: %s", e)
         else:
             print(f"Erro ao comprimir pasta: {str(e)}")
-        return False
+        return False, estatisticas
+
+
+def _remover_arquivo(arquivo):
+    """Remove um arquivo e retorna o caminho junto com o erro ocorrido (ou None)"""
+    try:
+        os.unlink(arquivo)
+        return arquivo, None
+    except OSError as e:
+        return arquivo, e
 
 
 def limpar_backups_antigos(pasta_backup, manter_quantidade, logger=None):
@@ -115,43 +294,54 @@ def limpar_backups_antigos(pasta_backup, manter_quantidade, logger=None):
         logger: Objeto logger para registrar as operações
     """
     if logger:
-        logger.info(f"Verificando backups antigos em: {pasta_backup}")
-        logger.info(f"Número de backups a manter: {manter_quantidade}")
+        logger.info("Verificando backups antigos em: %s", pasta_backup)
+        logger.info("Número de backups a manter: %s", manter_quantidade)
     
     try:
-        # Lista todos os arquivos de backup
-        padrão = os.path.join(pasta_backup, "backup_*.tar.gz")
-        arquivos = glob.glob(padrão)
+        # Lista todos os arquivos de backup com a data de modificação em uma única passagem.
+        # O nome é verificado antes do tipo para não consultar arquivos que não são backups
+        with os.scandir(pasta_backup) as entradas:
+            arquivos = [
+                (entry.stat().st_mtime, entry.path)
+                for entry in entradas
+                if entry.name.startswith(PREFIXO_BACKUP)
+                and entry.name.endswith(EXTENSAO_BACKUP)
+                and entry.is_file()
+            ]
         
         if logger:
-            logger.debug(f"Total de backups encontrados: {len(arquivos)}")
-        
-        # Ordena os arquivos pela data de modificação (mais antigos primeiro)
-        arquivos_ordenados = sorted(arquivos, key=os.path.getmtime)
+            logger.debug("Total de backups encontrados: %s", len(arquivos))
         
-        # Remove os arquivos excedentes (mais antigos)
-        arquivos_para_remover = arquivos_ordenados[:-manter_quantidade] if len(arquivos_ordenados) > manter_quantidade else []
+        # Seleciona apenas os arquivos excedentes (mais antigos), sem ordenar os que serão mantidos
+        quantidade_remover = max(0, len(arquivos) - manter_quantidade) if manter_quantidade > 0 else 0
+        arquivos_para_remover = [caminho for _, caminho in heapq.nsmallest(quantidade_remover, arquivos)]
         
         if logger:
-            logger.debug(f"Arquivos a serem removidos: {len(arquivos_para_remover)}")
+            logger.debug("Arquivos a serem removidos: %s", len(arquivos_para_remover))
         
-        for arquivo in arquivos_para_remover:
-            try:
-                os.remove(arquivo)
-                if logger:
-                    logger.info(f"Backup antigo removido: {arquivo}")
+        # As remoções são feitas em paralelo para sobrepor a latência de sistemas de arquivos lentos
+        removidos = 0
+        if arquivos_para_remover:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                resultados = list(executor.map(_remover_arquivo, arquivos_para_remover))
+            
+            for arquivo, erro in resultados:
+                if erro is None:
+                    removidos += 1
+                elif logger:
+                    logger.error("Erro ao remover arquivo %s: %s", arquivo, erro)
                 else:
-                    print(f"> Backup antigo removido: {arquivo}")
-            except Exception as e:
-                if logger:
-                    logger.error(f"Erro ao remover arquivo {arquivo}: {str(e)}")
-                else:
-                    print(f"Erro ao remover arquivo {arquivo}: {str(e)}")
+                    print(f"Erro ao remover arquivo {arquivo}: {str(erro)}")
+        
+        if logger:
+            logger.info("Backups antigos removidos: %s", removidos)
+        else:
+            print(f"> Backups antigos removidos: {removidos}")
         
         return True
     except Exception as e:
         if logger:
-            logger.error(f"Erro ao limpar backups antigos: {str(e)}")
+            logger.error("Erro ao limpar backups antigos: %s", e)
         else:
             print(f"Erro ao limpar backups antigos: {str(e)}")
         return False
@@ -174,33 +364,48 @@ def main():
     
     if not args.log:
         # Configura o diretório de logs
-        log_dir = os.path.join(args.pasta_destino, 'logs')
+        log_dir = os.path.join(args.pasta_destino, PASTA_LOGS)
         os.makedirs(log_dir, exist_ok=True)
 
         # Define nome do arquivo de log com data/hora se não especificado    
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        log_file = os.path.join(log_dir, f"backup_{timestamp}.log")
+        log_file = os.path.join(log_dir, f"{PREFIXO_BACKUP}{timestamp}{EXTENSAO_LOG}")
     else:
         log_file = args.log
     
     # Configura o logger
-    logger = configurar_logger(log_file)
+    logger, listener = configurar_logger(log_file)
     
     if args.verbose:
         # Definir nível de log mais detalhado se verbose estiver ativado
         logger.setLevel(logging.DEBUG)
-        for handler in logger.handlers:
+        for handler in listener.handlers:
             handler.setLevel(logging.DEBUG)
     
+    try:
+        executar_backup(args, logger)
+    finally:
+        # Garante que todas as mensagens enfileiradas sejam escritas
+        listener.stop()
+
+
+def executar_backup(args, logger):
+    """
+    Executa o backup e a limpeza dos backups antigos
+    
+    Args:
+        args: Argumentos da linha de comando
+        logger: Objeto logger para registrar as operações
+    """
     # Registra início do backup
     logger.info("=" * 60)
-    logger.info(f"Iniciando processo de backup em {datetime.datetime.now()}")
-    logger.info(f"Origem: {args.pasta_origem}")
-    logger.info(f"Destino: {args.pasta_destino}")
+    logger.info("Iniciando processo de backup em %s", datetime.datetime.now())
+    logger.info("Origem: %s", args.pasta_origem)
+    logger.info("Destino: %s", args.pasta_destino)
     
     # Garante que as pastas existem
     if not os.path.exists(args.pasta_origem):
-        logger.error(f"Erro: A pasta de origem '{args.pasta_origem}' não existe!")
+        logger.error("Erro: A pasta de origem '%s' não existe!", args.pasta_origem)
         return
     
     os.makedirs(args.pasta_destino, exist_ok=True)
@@ -210,31 +415,29 @@ def main():
     nome_pasta = os.path.basename(os.path.normpath(args.pasta_origem))
     arquivo_backup = os.path.join(
         args.pasta_destino, 
-        f"backup_{nome_pasta}_{data_atual}.tar.gz"
+        f"{PREFIXO_BACKUP}{nome_pasta}_{data_atual}{EXTENSAO_BACKUP}"
     )
     
-    # Registra estatísticas iniciais
-    tamanho_origem = calcular_tamanho_diretorio(args.pasta_origem)
-    logger.info(f"Tamanho original: {tamanho_origem} bytes ({formatar_tamanho(tamanho_origem)})")
-    
-    # Registra hora de início
-    hora_inicio = datetime.datetime.now()
+    # Registra o instante de início (relógio monotônico, imune a ajustes do relógio do sistema)
+    inicio_ns = time.monotonic_ns()
     
     # Realiza o backup
-    sucesso_compressao = comprimir_pasta(args.pasta_origem, arquivo_backup, args.compressao, logger)
+    sucesso_compressao, estatisticas = comprimir_pasta(
+        args.pasta_origem, arquivo_backup, args.compressao, logger,
+        excluir_logs=not args.log
+    )
     
     # Calcula tempo de execução
-    hora_fim = datetime.datetime.now()
-    duracao = hora_fim - hora_inicio
+    duracao = (time.monotonic_ns() - inicio_ns) / 1e9
     
     if sucesso_compressao:
         # Registra estatísticas finais
-        tamanho_backup = os.path.getsize(arquivo_backup)
-        taxa_compressao = tamanho_origem / tamanho_backup if tamanho_backup > 0 else 0
+        logger.info("Arquivos no backup: %s", estatisticas.arquivos)
+        logger.info("Tamanho original: %s bytes (%s)", estatisticas.tamanho_origem, formatar_tamanho(estatisticas.tamanho_origem))
         
-        logger.info(f"Tamanho do backup: {tamanho_backup} bytes ({formatar_tamanho(tamanho_backup)})")
-        logger.info(f"Taxa de compressão: {taxa_compressao:.2f}x")
-        logger.info(f"Tempo de execução: {duracao.total_seconds():.2f} segundos")
+        logger.info("Tamanho do backup: %s bytes (%s)", estatisticas.tamanho_backup, formatar_tamanho(estatisticas.tamanho_backup))
+        logger.info("Taxa de compressão: %.2fx", estatisticas.taxa_compressao)
+        logger.info("Tempo de execução: %.2f segundos", duracao)
         
         # Limpa backups antigos
         limpar_backups_antigos(args.pasta_destino, args.manter, logger)
@@ -242,28 +445,17 @@ def main():
         logger.error("Backup falhou!")
     
     # Registra fim do backup
-    logger.info(f"Processo de backup finalizado em {datetime.datetime.now()}")
+    logger.info("Processo de backup finalizado em %s", datetime.datetime.now())
     logger.info("=" * 60)
 
 
-def calcular_tamanho_diretorio(diretorio):
-    """Calcula o tamanho total de um diretório em bytes"""
-    tamanho_total = 0
-    for dirpath, dirnames, filenames in os.walk(diretorio):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if os.path.exists(fp):
-                tamanho_total += os.path.getsize(fp)
-    return tamanho_total
-
-
 def formatar_tamanho(tamanho_bytes):
     """Formata o tamanho em bytes para uma string legível (KB, MB, GB)"""
-    for unidade in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if tamanho_bytes < 1024.0:
-            return f"{tamanho_bytes:.2f} {unidade}"
-        tamanho_bytes /= 1024.0
-    return f"{tamanho_bytes:.2f} PB"
+    if tamanho_bytes < 1024:
+        return f"{tamanho_bytes} B"
+    # Cada unidade corresponde a 10 bits, então o número de bits escolhe a unidade
+    indice = min((int(tamanho_bytes).bit_length() - 1) // 10, len(UNIDADES_TAMANHO) - 1)
+    return f"{tamanho_bytes / (1 << (indice * 10)):.2f} {UNIDADES_TAMANHO[indice]}"
 
 
 if __name__ == "__main__":